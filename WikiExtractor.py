@@ -41,15 +41,33 @@
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from bz2 import BZ2File
+from collections import deque
 from gzip import GzipFile
 from html.entities import name2codepoint
+from itertools import count, islice
 from mimetypes import guess_type
+from multiprocessing import Pool
+from os import cpu_count
 from string import punctuation
-from typing import TextIO
+from time import monotonic
+from typing import BinaryIO, Iterator, TextIO
+from xml.etree.ElementTree import iterparse
 import re
 
-# For status updates
-counter = 0
+# Parallel bzip2 decompression is optional; fall back to `BZ2File` without it
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
+
+# Seconds between status updates
+status_interval = 5.0
+
+# Articles handed to a worker process at a time
+pages_per_task = 64
+
+# Bytes buffered before the output file is flushed
+output_buffer_size = 1 << 20
 
 # This is obtained from the dump itself.
 prefix = None
@@ -60,9 +78,8 @@ discard_elements = {'gallery', 'timeline', 'noinclude', 'pre', 'table', 'tr', 't
                     'references', 'img', 'imagemap', 'source'}
 
 # PATTERNS
-discard_element_patterns = []
-ignored_tag_patterns = []
-self_closing_tag_patterns = []
+discard_element_pattern = None
+dropped_span_pattern = None  # Comments, self-closing tags and ignored tags
 placeholder_tag_patterns = []
 
 # TAGS
@@ -74,23 +91,34 @@ ignored_tags = [
     'sub', 'sup', 'tt', 'u', 'var',
 ]
 placeholder_tags = {'math': '<<MATH>>', 'code': '<<CODE>>'}
+# Characters for every named HTML entity and for the decimal references below 256, keyed by the full reference
+decoded_entities = {f'&{name};': chr(code) for name, code in name2codepoint.items()}
+decoded_entities.update({f'&#{code};': chr(code) for code in range(256)})
+# Replacements for unpaired bold/italic markup
+leftover_quotes = {"'''": '', "''": '&quot;'}
 
 # REGEXES
 UNESCAPE = re.compile(r'&#?(\w+);')
 PREFORMATTED = re.compile(r'^ .*?$', re.MULTILINE)
-EXTERNAL_LINK = re.compile(r'\[\w+.*? (.*?)]')  # Space separates second optional parameter
+# Space separates second optional parameter. Same matches as `\[\w+.*? (.*?)]`, but the negated classes leave
+# nothing to backtrack into, which was cubic on lines full of unclosed `[word ` brackets.
+EXTERNAL_LINK = re.compile(r'\[\w[^ \n]* ([^\]\n]*)]')
 EXTERNAL_LINK_NO_ANCHOR = re.compile(r'\[\w+[&\]]*]')
 BOLD_ITALIC = re.compile(r"'''''([^']*?)'''''")
 BOLD = re.compile(r"'''(.*?)'''")
 ITALIC_QUOTE = re.compile(r"''\"(.*?)\"''")
 ITALIC = re.compile(r"''([^']*)''")
 QUOTE_QUOTE = re.compile(r'""(.*?)""')
+LEFTOVER_QUOTES = re.compile(r"'''|''")
 SPACES = re.compile(r' {2,}')
 WHITESPACE = re.compile(r'\s')
 DOTS = re.compile(r'\.{4,}')
 PARAMETRIZED_LINK = re.compile(r'(?:\[\[.*\|)|(?:]])')
 COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
-TAGS = re.compile(r'(.*?)<(/?\w+)[^>]*>(?:([^<]*)(<.*?>)?)?')
+TEMPLATE_OPEN = re.compile(r'{{')
+TEMPLATE_CLOSE = re.compile(r'}}')
+TABLE_OPEN = re.compile(r'{\|')
+TABLE_CLOSE = re.compile(r'\|}')
 TITLE = re.compile(r'[\s_]+')
 TITLE_MATCH = re.compile(r'([^:]*):(\s*)(\S(?:.*))')
 SECTION = re.compile(r'(==+)\s*(.*?)\s*\1')
@@ -134,33 +162,36 @@ def normalize_title(title: str) -> str:
         return title.capitalize()
 
 
+def fixup_entity(m: re.Match, _decoded: dict = decoded_entities) -> str:
+    """Function applied to UNESCAPE matches; `_decoded` binds the entity table as a local."""
+    text = m.group(0)
+    # Common references are a single lookup
+    char = _decoded.get(text)
+    if char is not None:
+        return char
+    if text[1] == '#':
+        # Other character reference
+        code = m.group(1)
+        if text[2] == 'x':
+            return chr(int(code[1:], 16))
+        else:
+            return chr(int(code))
+    # Unknown named entity, leave as-is
+    return text
+
+
 # Removes HTML or XML character references and entities from a text string.
+# The dump's own XML escaping is already undone by the parser, so a single pass decodes the wikitext entities.
 # @param text The HTML (or XML) source text.
 # @return The plain text, as a Unicode string, if necessary.
 def unescape(text: str) -> str:
-    def fixup(m: re.Match) -> str:
-        text_inner = m.group(0)
-        code = m.group(1)
-        if text_inner[1] == '#':
-            # Character reference
-            if text_inner[2] == 'x':
-                return chr(int(code[1:], 16))
-            else:
-                return chr(int(code))
-        elif code in name2codepoint:
-            # Named entity
-            return chr(name2codepoint[code])
-        else:
-            # Leave as-is
-            return text_inner
-
-    return UNESCAPE.sub(fixup, text)
+    if '&' not in text:
+        return text
+    return UNESCAPE.sub(fixup_entity, text)
 
 
-def drop_nested(text: str, open_delim: str, close_delim: str) -> str:
+def drop_nested(text: str, open_re: re.Pattern, close_re: re.Pattern) -> str:
     """A matching function for nested expressions, e.g. namespaces and tables."""
-    open_re = re.compile(open_delim)
-    close_re = re.compile(close_delim)
     # Partition text in separate blocks { } { }
     matches = []  # Pairs (s, e) for each partition
     nest = 0  # Nesting level
@@ -205,25 +236,24 @@ def drop_nested(text: str, open_delim: str, close_delim: str) -> str:
             # { { }
             nest += 1
     # Collect text outside partitions
-    res = ''
+    res = []
     start = 0
     for s, e in matches:
-        res += text[start:s]
+        res.append(text[start:s])
         start = e
-    res += text[start:]
-    return res
+    res.append(text[start:])
+    return ''.join(res)
 
 
 def drop_spans(matches, text: str) -> str:
-    """Drop text from blocks identified in matches."""
-    matches.sort()
-    res = ''
+    """Drop text from blocks identified in matches, which must be ordered and non-overlapping."""
+    res = []
     start = 0
     for s, e in matches:
-        res += text[start:s]
+        res.append(text[start:s])
         start = e
-    res += text[start:]
-    return res
+    res.append(text[start:])
+    return ''.join(res)
 
 
 def make_anchor_tag(match: re.Match) -> str:
@@ -241,15 +271,17 @@ def clean(text: str) -> str:
     # FIXME: templates should be expanded
     # Drop transclusions (template, parser functions)
     # See: http://www.mediawiki.org/wiki/Help:Templates
-    text = drop_nested(text, r'{{', r'}}')
+    text = drop_nested(text, TEMPLATE_OPEN, TEMPLATE_CLOSE)
 
     # Drop tables
-    text = drop_nested(text, r'{\|', r'\|}')
+    text = drop_nested(text, TABLE_OPEN, TABLE_CLOSE)
 
     # Expand links
     text = WIKI_LINK.sub(make_anchor_tag, text)
-    # Drop all remaining ones (except link text)
-    text = PARAMETRIZED_LINK.sub('', text)
+    # Drop all remaining ones (except link text). The pattern has no literal prefix to search for, so the regex
+    # engine tries it at every position; skip it when the text has no leftover link brackets.
+    if '[[' in text or ']]' in text:
+        text = PARAMETRIZED_LINK.sub('', text)
 
     # Handle external links
     text = EXTERNAL_LINK.sub(r'\1', text)
@@ -261,43 +293,22 @@ def clean(text: str) -> str:
     text = ITALIC_QUOTE.sub(r'&quot;\1&quot;', text)
     text = ITALIC.sub(r'&quot;\1&quot;', text)
     text = QUOTE_QUOTE.sub(r'\1', text)
-    text = text.replace("'''", '').replace("''", '&quot;')
+    text = LEFTOVER_QUOTES.sub(lambda m: leftover_quotes[m.group()], text)
 
     # Process HTML
-    # Turn into HTML
-    text = unescape(text)
-    # Do it again (&amp;nbsp;)
     text = unescape(text)
 
-    # Collect spans
-    matches = []
-    # Drop HTML comments
-    for m in COMMENT.finditer(text):
-        matches.append((m.start(), m.end()))
-
-    # Drop self-closing tags
-    for pattern_shadow in self_closing_tag_patterns:
-        for m in pattern_shadow.finditer(text):
-            matches.append((m.start(), m.end()))
-
-    # Drop ignored tags
-    for left, right in ignored_tag_patterns:
-        for m in left.finditer(text):
-            matches.append((m.start(), m.end()))
-        for m in right.finditer(text):
-            matches.append((m.start(), m.end()))
-
-    # Bulk remove all spans
+    # Drop HTML comments, self-closing tags and ignored tags in one scan, which yields the spans already in order
+    matches = [m.span() for m in dropped_span_pattern.finditer(text)]
     text = drop_spans(matches, text)
 
     # Drop discarded elements: can't use dropSpan on these since they may be nested
-    for pattern_shadow in discard_element_patterns:
-        text = pattern_shadow.sub('', text)
+    text = discard_element_pattern.sub('', text)
 
     # Expand placeholders
     for pattern_shadow, placeholder in placeholder_tag_patterns:
-        for i, match in enumerate(pattern_shadow.finditer(text)):
-            text = text.replace(match.group(), f'{placeholder}_{i + 1}')
+        index = count(1)
+        text = pattern_shadow.sub(lambda m: f'{placeholder}_{next(index)}', text)
 
     # Drop preformatted: this can't be done before since it may remove tags
     text = PREFORMATTED.sub('', text)
@@ -312,10 +323,11 @@ def clean(text: str) -> str:
     old_text_len = -1
     new_text_len = 0
     while old_text_len != new_text_len:  # Always enter at least once!
-        # Update old text length
-        old_text_len = len(text)
         text = SPACES.sub(' ', text)  # Substitute 1 space anywhere where there are 2 or more consecutive spaces
         text = DOTS.sub('...', text)  # Replace more than 4 dots with 3
+        # Neither rule above can create a match for itself or the other, so only the rules below decide whether
+        # another pass is needed: when they change nothing, this pass already left the text at its fixed point.
+        old_text_len = len(text)
         text = PUNCTUATION.sub('\n', text)  # Lines with only punctuation
         text = UNDERSCORE_NAME.sub('', text)  # Instances of form: `__[capital letter but not digit]__`
         text = RIGHT_HEAVY_DASHED_PARENTHETICALS.sub('', text)  # Transform instances of `( - [text])` into `([text])`
@@ -323,7 +335,7 @@ def clean(text: str) -> str:
         text = DUPLICATE_QUOTES.sub('"', text)  # Replace two or more consecutive quotes with just one
         text = EMPTY_BRACKETS.sub('', text)  # Remove empty bracket statements
         text = text.replace('..', '.')  # Reduce two periods to a singular one
-        text = COMMAS.sub(',', text).replace(',.', '.').replace('.,.', '.')  # Fix weird comma patterns
+        text = COMMAS.sub(',', text).replace(',.', '.')  # Fix weird comma patterns
         text = EMPTY_COMMAS.sub(',', text)  # Replace empty comma-delimited expressions with a singular comma
         # Remove lone, dangling commas inside parenthetical statements
         text = LONE_COMMA_LEFT.sub('(', text)
@@ -358,6 +370,7 @@ def compact(text: str) -> list[str]:
                         del headers[i]
                 empty_section = True
                 continue
+            first = line[0]
             # Handle page title
             if line.startswith('++'):
                 title = line[2:-2]
@@ -366,13 +379,13 @@ def compact(text: str) -> list[str]:
                         title += '.'
                     page.append(title)
             # Handle lists
-            elif line[0] in '*#:;':
+            elif first in '*#:;':
                 continue
             # Drop residuals of lists
-            elif line[0] in '{|' or line[-1] in '}':
+            elif first in '{|' or line[-1] == '}':
                 continue
             # Drop irrelevant lines
-            elif (line[0] == '(' and line[-1] == ')') or line.strip('.-') == '':
+            elif (first == '(' and line[-1] == ')') or not line.strip('.-'):
                 continue
             elif len(headers):
                 for _, v in sorted(headers.items(), key=lambda item: item[0]):
@@ -393,88 +406,89 @@ def handle_unicode(entity: str) -> str:
     return chr(numeric_code)
 
 
-def wiki_document_sentences(outfile: TextIO, title: str, text: str) -> None:
-    global counter
-    counter += 1
-    if counter & ((1 << 14) - 1) == 0:
-        # Check if counter is divisible by 2^14 efficiently and print status update
-        print(f'...processed {counter:,} articles.')
-    outfile.write(f'<<<{title}>>>\n')
-    for line in compact(clean(text)):
-        outfile.write(f'{line}\n')
+def extract_sentences(page: tuple[str, str]) -> tuple[str, list[str]]:
+    """Clean a single `(title, text)` article; runs in the worker processes."""
+    title, text = page
+    return title, compact(clean(text))
+
+
+def wiki_document_sentences(outfile: TextIO, title: str, lines: list[str]) -> None:
+    # One write per article rather than one per line
+    outfile.write('\n'.join([f'<<<{title}>>>', *lines, '']))
 
 
-def process_data(file_type: str, input_shadow, output_sentences) -> None:
+def extract_pages(input_shadow: BinaryIO) -> Iterator[tuple[str, str]]:
+    """Yield `(title, text)` for every article in the dump, skipping redirects and namespaced pages."""
     global prefix
-    page = []
-    id_shadow = None
-    in_text = False
-    redirect = False
-    for line in input_shadow:
-        if file_type != 'xml':
-            line = str(line.decode('utf-8'))
-        tag_shadow = ''
-        if '<' in line:
-            m = TAGS.search(line)
-            if m:
-                tag_shadow = m.group(2)
+    # Stream the dump and only look at complete elements; namespaces are matched with `{*}`
+    root = None
+    for event, elem in iterparse(input_shadow, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        tag_shadow = elem.tag.rpartition('}')[2]
         if tag_shadow == 'page':
-            page = []
-            redirect = False
-        elif tag_shadow == 'id' and not id_shadow:
-            id_shadow = m.group(3)
-        elif tag_shadow == 'title':
-            title = m.group(3)
-        elif tag_shadow == 'redirect':
-            redirect = True
-        elif tag_shadow == 'text':
-            in_text = True
-            line = line[m.start(3):m.end(3)] + '\n'
-            page.append(line)
-            if m.lastindex == 4:  # open-close
-                in_text = False
-        elif tag_shadow == '/text':
-            if m.group(1):
-                page.append(m.group(1) + '\n')
-            in_text = False
-        elif in_text:
-            page.append(line)
-        elif tag_shadow == '/page':
-            colon = title.find(':')
-            if colon < 0 and not redirect:
-                wiki_document_sentences(output_sentences, title, ''.join(page))
-            id_shadow = None
-            page = []
+            title = elem.findtext('{*}title')
+            redirect = elem.find('{*}redirect') is not None
+            if ':' not in title and not redirect:
+                # The parser has already undone the dump's XML escaping, so this is the wikitext as written
+                yield title, elem.findtext('{*}revision/{*}text', '')
+            # Detach the parsed page from the root so the tree doesn't grow with the dump
+            root.clear()
         elif tag_shadow == 'base':
             # discover prefix from the xml dump file
             # /mediawiki/siteinfo/base
-            base = m.group(3)
+            base = elem.text
             prefix = base[:base.rfind('/')]
 
 
-def init() -> None:
-    global discard_element_patterns, ignored_tags, ignored_tag_patterns, self_closing_tag_patterns, \
-        placeholder_tag_patterns
+def clean_pages(pages: Iterator[tuple[str, str]], processes: int) -> Iterator[tuple[str, list[str]]]:
+    """Yield `(title, lines)` for every page, in order, cleaning them in `processes` worker processes."""
+    if processes > 1:
+        with Pool(processes, initializer=init) as pool:
+            # Batches are submitted from this thread and collected in dump order. Capping the pending ones bounds
+            # the read-ahead, and `get()` re-raises any error from a worker here.
+            pending = deque()
+            for batch in iter(lambda: list(islice(pages, pages_per_task)), []):
+                if len(pending) == processes * 4:
+                    yield from pending.popleft().get()
+                pending.append(pool.map_async(extract_sentences, batch, chunksize=pages_per_task))
+            while pending:
+                yield from pending.popleft().get()
+    else:
+        init()
+        yield from map(extract_sentences, pages)
+
+
+def process_data(input_shadow: BinaryIO, output_sentences: TextIO, processes: int) -> None:
+    processed = 0
+    last_status = monotonic()
+    for title, lines in clean_pages(extract_pages(input_shadow), processes):
+        wiki_document_sentences(output_sentences, title, lines)
+        processed += 1
+        now = monotonic()
+        if now - last_status >= status_interval:
+            print(f'...processed {processed:,} articles.')
+            last_status = now
 
-    for tag in discard_elements:
-        pattern = re.compile(r'<\s*%s\b[^>]*>.*?<\s*/\s*%s>' % (tag, tag), re.DOTALL | re.IGNORECASE)
-        discard_element_patterns.append(pattern)
 
-    def ignore_tag(tag_shadow):
-        left = re.compile(r'<\s*%s\b[^>]*>' % tag_shadow, re.IGNORECASE)
-        right = re.compile(r'<\s*/\s*%s>' % tag_shadow, re.IGNORECASE)
-        ignored_tag_patterns.append((left, right))
+def init() -> None:
+    global discard_element_pattern, dropped_span_pattern, placeholder_tag_patterns
 
-    for tag in ignored_tags:
-        ignore_tag(tag)
+    # The closing tag must name the same element as the opening one, hence the backreference
+    discard_element_pattern = re.compile(r'<\s*(%s)\b[^>]*>.*?<\s*/\s*\1>' % '|'.join(sorted(discard_elements)),
+                                         re.DOTALL | re.IGNORECASE)
 
-    for tag in self_closing_tags:
-        pattern = re.compile(r'<\s*%s\b[^/]*/\s*>' % tag, re.DOTALL | re.IGNORECASE)
-        self_closing_tag_patterns.append(pattern)
+    # Everything removed as a plain span shares one alternation, so the text is scanned once for all of them
+    dropped_span_pattern = re.compile(r'%s|<\s*(?:%s)\b[^/]*/\s*>|<\s*(?:%s)\b[^>]*>|<\s*/\s*(?:%s)>' % (
+        COMMENT.pattern, '|'.join(self_closing_tags), '|'.join(ignored_tags), '|'.join(ignored_tags)),
+        re.DOTALL | re.IGNORECASE)
 
-    for tag, repl in list(placeholder_tags.items()):
-        pattern = re.compile(r'<\s*%s(\s*| [^>]+?)>.*?<\s*/\s*%s\s*>' % (tag, tag), re.DOTALL | re.IGNORECASE)
-        placeholder_tag_patterns.append((pattern, repl))
+    placeholder_tag_patterns = [
+        (re.compile(r'<\s*%s(\s*| [^>]+?)>.*?<\s*/\s*%s\s*>' % (tag, tag), re.DOTALL | re.IGNORECASE), repl)
+        for tag, repl in placeholder_tags.items()
+    ]
 
 
 def main() -> None:
@@ -485,23 +499,25 @@ def main() -> None:
                         help='Path to the Wikipedia dump file (uncompressed or bzip2).')
     parser.add_argument('-o', '--outfile', type=str, default='wiki.txt',
                         help='Path to the output file to save extracted Wikipedia dump text.')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count() or 1,
+                        help='Number of worker processes used to clean articles (and bzip2 decompression threads '
+                             'when indexed_bzip2 is installed). Articles are written in dump order either way.')
     args = parser.parse_args()
 
     print('Started processing...')
 
-    init()
-
     file_type = guess_type(args.infile)
     if 'bzip2' in file_type:
-        with open(args.outfile, 'w', encoding='utf-8') as outfile:
-            process_data('bzip2', BZ2File(args.infile), outfile)
+        if indexed_bzip2 is not None:
+            infile = indexed_bzip2.open(args.infile, parallelization=args.processes)
+        else:
+            infile = BZ2File(args.infile)
     elif 'gzip' in file_type:
-        with open(args.outfile, 'w', encoding='utf-8') as outfile:
-            process_data('gzip', GzipFile(args.infile), outfile)
+        infile = GzipFile(args.infile)
     else:
-        with open(args.infile, encoding='utf-8') as infile:
-            with open(args.outfile, 'w', encoding='utf-8') as outfile:
-                process_data('xml', infile, outfile)
+        infile = open(args.infile, 'rb')
+    with infile, open(args.outfile, 'w', encoding='utf-8', buffering=output_buffer_size) as outfile:
+        process_data(infile, outfile, args.processes)
 
 
 if __name__ == '__main__':